@@ -1,10 +1,17 @@
 # smart_form_filler_app.py
 
 import os
+import asyncio
 import json
-import re
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from array import array
 from io import BytesIO
 import fitz  # PyMuPDF
+import numpy as np
+import orjson
 import pathlib
 import streamlit as st
 from google import genai
@@ -13,8 +20,14 @@ from google.genai import types
 # ── CONFIGURATION ──────────────────────────────────────────────────────────────
 # Load API key
 API_KEY = ""  # NOTE <- YOUR API KEY HERE
-MODEL_CTX = "gemini-2.0-flash"
 MODEL_MAP = "gemini-2.0-flash"
+MAX_IN_FLIGHT = 8  # concurrent page requests to Gemini
+# Input budget for mapping the whole form in one request; Gemini 2.0 Flash
+# accepts ~1M input tokens. Larger forms fall back to per-page requests.
+FORM_TOKEN_LIMIT = 1_000_000
+# Bounds for the cached Gemini results (patient data and field mappings)
+RESULT_CACHE_TTL = 3600  # seconds
+RESULT_CACHE_MAX_ENTRIES = 32
 PDF_PATH = "PA.pdf"
 REFERRAL_PROMPT = (
     """
@@ -36,84 +49,498 @@ REFERRAL_PROMPT = (
     """
 )
 
+# Identical for every page and sent ahead of anything page-specific, so
+# Gemini's implicit prefix cache can serve it (and patient info) on pages 2..N.
+PAGE_FILL_PROMPT = (
+    """
+        You’re filling one page of the attached Prior Authorization form.
+        Given:
+        1. This page’s form fields (id,type,rect).
+        2. Detailed patient info.
+        You are a smart form-filling assistant. Work in two steps.
+
+        STEP 1 - CONTEXT
+        For each field:
+        Move sequentially through the page for each field along with fields info attached.
+        Add its question i.e what is the question asked for CB1 or T1 for all the fields.
+        Generate the best possible context around that field object in 25 words. Provide a proper context to actually give more insight into what the question actually is. If the question needs any background info to make sense, add that into the context.
+        Sometimes, the question itself does not give a lot of context. For example if a question is First Name it should be known if it is the patients name or the insurer's. Also if a question is a sub question of another question, it should be known the context of it.
+        Getting the correct context for correct field is extremely important for correct mapping.
+        Each context object should only contain the fields - name, page, question, context in the following format
+        {"name": "T67", "page": 2, "question": "","context": "" }
+
+        STEP 2 - MAPPING
+        Carefully look into the context and question you found for each field. Then see if the patient info has information for it. If it has good create mapping. But if it does not have do not create a mapping for it.
+
+        Be intelligent in creating mappings. See the context and decide on the mapping. Make full use of understanding context.
+        Do not map inappropriate content with inappropriate field.
+
+            Cleverly match the right patient info to applicable field. Use the info from patient info to map form fields based on questions and context from structured info. Use:
+            - Text for text fields
+            - `true` / `false` for checkboxes
+            - Leave irrelevant fields blank or `false`
+            - Do Not fill in the fields for which information is not present in patient info
+
+            A name field should be filled with name, an address field with address etc.
+            Do not add the field in mapping if info about it is not present.
+
+        Only output valid JSON in this format:
+        {"contexts": {field_id: context_object}, "mapping": {field_id: value}}
+    """
+)
+
+# Whole-form variant of PAGE_FILL_PROMPT, used when everything fits in one request
+FORM_FILL_PROMPT = (
+    """
+        pdf1 is a referral package for a patient and pdf2 is the Prior Authorization form to fill.
+        Given:
+        1. Every form field of pdf2 (id,type,rect), grouped by page.
+        2. Detailed patient info extracted from pdf1.
+        You are a smart form-filling assistant.
+
+        For each field, move sequentially through its page and work out the question asked for it and the context in which it is asked.
+        Sometimes, the question itself does not give a lot of context. For example if a question is First Name it should be known if it is the patients name or the insurer's. Also if a question is a sub question of another question, it should be known the context of it.
+        Getting the correct context for correct field is extremely important for correct mapping.
+
+        Then see if the patient info (or pdf1 itself) has information for it. If it has good create mapping. But if it does not have do not create a mapping for it.
+
+        Be intelligent in creating mappings. See the context and decide on the mapping. Make full use of understanding context.
+        Do not map inappropriate content with inappropriate field.
+
+            Cleverly match the right patient info to applicable field. Use:
+            - Text for text fields
+            - `true` / `false` for checkboxes
+            - Leave irrelevant fields blank or `false`
+            - Do Not fill in the fields for which information is not present in patient info
+
+            A name field should be filled with name, an address field with address etc.
+            Do not add the field in mapping if info about it is not present.
+
+        Only output valid JSON in this format:
+        {"mapping": {field_id: value}}
+    """
+)
+
 # Initialize Gemini client
 client = genai.Client(api_key=API_KEY)
 
 # ── UTILITIES ───────────────────────────────────────────────────────────────────
-def extract_json(text):
+# Mapping values that tick a checkbox; anything else (including "false") clears it
+_CHECKBOX_TRUE = frozenset({True, 1, "true", "True", "TRUE", "yes", "Yes", "YES", "on", "On", "1"})
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def _repair_json(text):
+    """
+    Single-pass repair of the first JSON object in an LLM response: skips any
+    text before the first "{", quotes bare object keys and drops trailing
+    commas. A response that ends with a string or bracket still open was cut
+    off, so it raises ValueError rather than inventing a complete object.
+    """
     start = text.find("{")
-    end   = text.rfind("}")
-    if start == -1 or end == -1:
+    if start == -1:
         raise ValueError("No JSON object found")
-    raw = text[start:end+1]
-    raw = re.sub(r'(?m)^\s*([A-Za-z0-9_]+)\s*:', r'"\1":', raw)
-    raw = re.sub(r',\s*([}\]])', r'\1', raw)
-    return raw
+    out = []
+    stack = []
+    in_string = False
+    prev = ""  # last significant character emitted outside strings
+    i, n = start, len(text)
+    while i < n:
+        ch = text[i]
+        if in_string:
+            out.append(ch)
+            if ch == "\\" and i + 1 < n:
+                out.append(text[i + 1])
+                i += 1
+            elif ch == '"':
+                in_string = False
+                prev = ch
+        elif ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch in _CLOSERS:
+            stack.append(_CLOSERS[ch])
+            out.append(ch)
+            prev = ch
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            out.append(ch)
+            prev = ch
+            if not stack:
+                break
+        elif ch == ",":
+            j = i + 1
+            while j < n and text[j].isspace():
+                j += 1
+            if j < n and text[j] in "}]":
+                i = j  # drop the trailing comma; the closer is handled next
+                continue
+            out.append(ch)
+            prev = ch
+        elif (ch.isalnum() or ch == "_") and prev in "{,":
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            k = j
+            while k < n and text[k].isspace():
+                k += 1
+            word = text[i:j]
+            if k < n and text[k] == ":" and stack and stack[-1] == "}":
+                word = f'"{word}"'
+            out.append(word)
+            prev = word[-1]
+            i = j
+            continue
+        else:
+            out.append(ch)
+            if not ch.isspace():
+                prev = ch
+        i += 1
+    if in_string or stack:
+        raise ValueError("JSON object is truncated")
+    return "".join(out)
+
+
+def extract_json(text):
+    """
+    Parses the JSON object in a Gemini response and returns it as a dict.
+    Well-formed JSON is parsed directly; anything else goes through
+    _repair_json first. Uses the stdlib parser, which keeps integers of any
+    width exact (orjson turns wide ones, e.g. member IDs, into floats).
+    """
+    try:
+        result = json.loads(text)
+        if isinstance(result, dict):
+            return result
+    except ValueError:
+        pass
+    return json.loads(_repair_json(text))
+
+
+def spool_upload(uploaded_file, workdir):
+    """
+    Copies a Streamlit upload to a temp file in 1 MiB chunks. The upload itself
+    is already an in-memory buffer; spooling it means fitz and Gemini read the
+    file from disk instead of each getting another full bytes copy.
+    Returns (path, content digest).
+    """
+    # Full-length digest: it keys the result caches that every session shares
+    digest = hashlib.blake2b()
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(dir=workdir, suffix=".pdf", delete=False) as tmp:
+        while chunk := uploaded_file.read(1 << 20):
+            digest.update(chunk)
+            tmp.write(chunk)
+    return tmp.name, digest.hexdigest()
+
+
+def upload_pdf(path):
+    """
+    Uploads a PDF from disk through the Gemini Files API and returns a Part
+    referencing it by URI.
+    """
+    uploaded = client.files.upload(
+        file=path,
+        config=types.UploadFileConfig(mime_type="application/pdf")
+    )
+    return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type)
 
 # Wrap referral context extraction code exactly
 
-def extract_patient_info(referral_bytes, pa_bytes):
+async def extract_patient_info(pdf1, pdf2):
     """
     Runs the user-provided Gemini prompt to extract patient info.
+    pdf1 is the referral package and pdf2 the PA form, as uploaded Parts.
     """
-    pdf1 = types.Part.from_bytes(data=referral_bytes, mime_type='application/pdf')
-    pdf2 = types.Part.from_bytes(data=pa_bytes, mime_type='application/pdf')
-    response = client.models.generate_content(
+    response = (await client.aio.models.generate_content(
         model="gemini-2.0-flash",
         contents=[
             pdf1,
             pdf2,
             REFERRAL_PROMPT
         ]
-    ).text
+    )).text
     print(response)
-    raw = extract_json(response)
-    return json.loads(raw)
+    return extract_json(response)
 
 # Wrap existing page-by-page logic into functions
 
-def make_page_part(pdf_bytes, page_no):
+@st.cache_resource
+def _render_cache():
     """
-    Create a one-page PDF part from the given PDF bytes.
-    Tries to copy the form page; on XRef errors, falls back to image-based PDF.
+    (pdf digest, page_no) -> rendered single-page PDF bytes, least recently
+    used evicted first, plus the lock guarding it. Held by Streamlit so it
+    outlives the script reruns and is shared by every session thread.
     """
-    src = fitz.open(stream=pdf_bytes, filetype="pdf")
-    # Attempt to copy with widgets
-    try:
-        dst = fitz.open()  # new empty PDF
-        dst.insert_pdf(src, from_page=page_no-1, to_page=page_no-1)
-        # remove any leftover widget annotations to avoid XRef errors
-        for w in dst[0].widgets() or []:
-            dst[0].delete_widget(w)
-        buf = BytesIO()
-        dst.save(buf)
-        return types.Part.from_bytes(data=buf.getvalue(), mime_type="application/pdf")
-    except Exception:
-        # Fallback: render page as image PDF
-        page = src[page_no-1]
-        pix = page.get_pixmap()
-        new_pdf = fitz.open()
-        rect = page.rect
-        new_page = new_pdf.new_page(width=rect.width, height=rect.height)
-        new_page.insert_image(rect, pixmap=pix)
-        buf = BytesIO()
-        new_pdf.save(buf)
-        return types.Part.from_bytes(data=buf.getvalue(), mime_type="application/pdf")
-
-
-def extract_fields_with_positions(pdf_bytes):
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    fields = []
+    return OrderedDict(), threading.Lock()
+
+
+_rendered_pages, _rendered_pages_lock = _render_cache()
+_RENDERED_PAGES_MAX = 64
+
+
+def _render_page_pdf(src, pdf_digest, page_no):
+    """
+    Renders one page as a grayscale image PDF. Results are cached by content
+    digest, so retries and reruns on the same form skip the render.
+    110 dpi at JPEG quality 60 keeps form text legible while keeping the
+    upload small.
+    """
+    key = (pdf_digest, page_no)
+    with _rendered_pages_lock:
+        data = _rendered_pages.get(key)
+        if data is not None:
+            _rendered_pages.move_to_end(key)
+            return data
+    page = src[page_no-1]
+    pix = page.get_pixmap(colorspace=fitz.csGRAY, alpha=False, dpi=110)
+    new_pdf = fitz.open()
+    rect = page.rect
+    new_page = new_pdf.new_page(width=rect.width, height=rect.height)
+    # JPEG-encode the render; a raw pixmap would be embedded uncompressed
+    new_page.insert_image(rect, stream=pix.tobytes("jpeg", jpg_quality=60))
+    buf = BytesIO()
+    new_pdf.save(buf, garbage=4, deflate=True, clean=True)
+    data = buf.getvalue()
+    with _rendered_pages_lock:
+        _rendered_pages[key] = data
+        _rendered_pages.move_to_end(key)
+        while len(_rendered_pages) > _RENDERED_PAGES_MAX:
+            _rendered_pages.popitem(last=False)
+    return data
+
+
+def make_page_part(src, page_no, pdf_digest):
+    """
+    Create a one-page PDF part showing the given page as a grayscale image.
+    Gemini only needs the visual for question text and field geometry, and an
+    image page has no widgets to strip, so copying the page is never attempted.
+    """
+    data = _render_page_pdf(src, pdf_digest, page_no)
+    return types.Part.from_bytes(data=data, mime_type="application/pdf")
+
+
+def extract_fields_with_positions(doc):
+    """
+    Collects every widget on the form as parallel arrays indexed by position:
+    names, types (1 = checkbox, 0 = text), 1-based page numbers and an
+    (N, 4) float32 array of rects.
+    """
+    names = []
+    kinds = array("b")
+    pages = array("H")
+    rects = []
     for page_num, page in enumerate(doc, start=1):
         for w in page.widgets() or []:
-            fields.append({
-                "name":  w.field_name,
-                "type":  "checkbox" if w.field_type == fitz.PDF_WIDGET_TYPE_CHECKBOX else "text",
-                "value": w.field_value,
-                "page":  page_num,
-                "rect":  list(map(float, w.rect))
-            })
-    return fields
+            names.append(w.field_name)
+            kinds.append(w.field_type == fitz.PDF_WIDGET_TYPE_CHECKBOX)
+            pages.append(page_num)
+            r = w.rect
+            rects.append((r.x0, r.y0, r.x1, r.y1))
+    return {
+        "names": names,
+        "types": kinds,
+        "pages": pages,
+        "rects": np.asarray(rects, dtype=np.float32).reshape(-1, 4)
+    }
+
+
+def describe_fields(fields, indices):
+    """
+    JSON-ready (id, type, rect) objects for the fields at the given positions,
+    as sent to Gemini.
+    """
+    rects = np.round(fields["rects"][indices].astype(np.float64), 1).tolist()
+    return [
+        {
+            "id":   fields["names"][i],
+            "type": "checkbox" if fields["types"][i] else "text",
+            "rect": rect
+        }
+        for i, rect in zip(indices, rects)
+    ]
+
+
+def page_fill_prefix(patient_info):
+    """
+    The part of every page prompt that does not depend on the page:
+    instructions first, then patient info.
+    """
+    return [PAGE_FILL_PROMPT, "--- PATIENT INFO ---\n" + orjson.dumps(patient_info).decode()]
+
+
+async def cache_patient_info(patient_info):
+    """
+    Stores the shared page prompt prefix (instructions and patient info)
+    server-side so page calls can reference it by name instead of resending it.
+    Returns the cache name, or None if Gemini refuses (e.g. the content is
+    below the model's minimum cacheable size).
+    """
+    try:
+        cache = await client.aio.caches.create(
+            model=MODEL_MAP,
+            config=types.CreateCachedContentConfig(
+                contents=[types.Content(role="user", parts=[
+                    types.Part.from_text(text=text) for text in page_fill_prefix(patient_info)
+                ])],
+                ttl="600s"
+            )
+        )
+    except Exception as e:
+        print(f"Context caching unavailable, sending patient info inline: {e}")
+        return None
+    return cache.name
+
+
+async def get_page_fill(page_part, page_no, page_fields, patient_info, cache_name, in_flight):
+    """
+    Annotates one page's fields with question/context and maps patient info
+    onto them in a single Gemini call, so the page is only uploaded once.
+    When cache_name is given, the shared prefix is read from that cached
+    context; otherwise it is sent inline ahead of the page.
+    in_flight bounds how many page requests are outstanding at once.
+    Returns (contexts, mapping).
+    """
+    if cache_name:
+        prefix = []
+        config = types.GenerateContentConfig(cached_content=cache_name)
+    else:
+        prefix = page_fill_prefix(patient_info)
+        config = None
+    prompt = f"""
+        --- PAGE {page_no} FIELDS ---
+        {orjson.dumps(page_fields).decode()}
+        """
+    async with in_flight:
+        response = await client.aio.models.generate_content(
+            model=MODEL_MAP,
+            contents=prefix + [page_part, prompt],
+            config=config
+        )
+    # The mapping follows the contexts in the response, so a cut-off page
+    # would lose it; fail loudly rather than leave the page blank
+    if response.candidates and response.candidates[0].finish_reason == types.FinishReason.MAX_TOKENS:
+        raise ValueError(f"Page {page_no} response hit the output token limit")
+    resp = response.text
+    print(resp)
+    result = extract_json(resp)
+    return result.get("contexts", {}), result.get("mapping", {})
+
+
+async def fill_pages(src, pdf_digest, page_fields, patient_info):
+    """
+    Slices every page of src up front on this thread (PyMuPDF holds the GIL
+    and is not thread-safe, so there is nothing to gain from a worker), then
+    runs get_page_fill for all pages with at most MAX_IN_FLIGHT requests
+    outstanding. Returns ({page_no: contexts}, {page_no: mapping}).
+    """
+    page_parts = {p: make_page_part(src, p, pdf_digest) for p in page_fields}
+    cache_name = await cache_patient_info(patient_info)
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+    pages = list(page_fields)
+    try:
+        results = await asyncio.gather(*(
+            get_page_fill(page_parts[p], p, page_fields[p], patient_info, cache_name, in_flight)
+            for p in pages
+        ))
+    finally:
+        if cache_name:
+            await client.aio.caches.delete(name=cache_name)
+    contexts = {p: ctx for p, (ctx, _) in zip(pages, results)}
+    mappings = {p: mapping for p, (_, mapping) in zip(pages, results)}
+    return contexts, mappings
+
+
+async def fill_form(pa_part, ref_part, page_fields, patient_info):
+    """
+    Maps patient info onto every field of the form in one Gemini request,
+    attaching the whole PA form and referral package. Returns the mapping, or
+    None if the prompt exceeds FORM_TOKEN_LIMIT or the response is truncated at
+    the output token cap, in which case pages must be sent one by one.
+    """
+    fields_text = "\n".join(
+        f"--- PAGE {p} FIELDS ---\n{orjson.dumps(p_fields).decode()}"
+        for p, p_fields in sorted(page_fields.items())
+    )
+    contents = [
+        FORM_FILL_PROMPT,
+        "--- PATIENT INFO ---\n" + orjson.dumps(patient_info).decode(),
+        ref_part,
+        pa_part,
+        fields_text
+    ]
+    counted = await client.aio.models.count_tokens(model=MODEL_MAP, contents=contents)
+    if counted.total_tokens > FORM_TOKEN_LIMIT:
+        print(f"Form prompt is {counted.total_tokens} tokens, falling back to per-page requests")
+        return None
+    response = await client.aio.models.generate_content(
+        model=MODEL_MAP,
+        contents=contents
+    )
+    # A mapping cut off at the output token cap would be "repaired" into a
+    # silently partial one; let the per-page requests handle the form instead
+    if response.candidates and response.candidates[0].finish_reason == types.FinishReason.MAX_TOKENS:
+        print("Form mapping hit the output token limit, falling back to per-page requests")
+        return None
+    resp = response.text
+    print(resp)
+    return extract_json(resp).get("mapping", {})
+
+
+async def map_fields(src, pdf_digest, pa_part, ref_part, page_fields, patient_info):
+    """
+    Returns {field_id: value} for the whole form: from a single fill_form
+    request when it fits, otherwise from fill_pages merged in page order.
+    """
+    if not page_fields:  # no widgets on the form, nothing to ask Gemini
+        return {}
+    mapping = await fill_form(pa_part, ref_part, page_fields, patient_info)
+    if mapping is not None:
+        return mapping
+    _, mapping_by_page = await fill_pages(src, pdf_digest, page_fields, patient_info)
+    mapping = {}
+    for page_no in sorted(mapping_by_page):
+        mapping.update(mapping_by_page[page_no])
+    return mapping
+
+
+# Streamlit reruns the whole script on every interaction. These wrappers key
+# the Gemini steps on the upload digests, so pressing the button again on the
+# same files skips every Gemini call. Arguments starting with "_" are not
+# hashed by st.cache_data.
+
+@st.cache_data(show_spinner=False, ttl=47 * 3600)
+def cached_upload(digest, _path):
+    """
+    Uploads a PDF once per content digest; Gemini keeps uploaded files for
+    48 hours, so the Part is reused until shortly before it expires.
+    """
+    return upload_pdf(_path)
+
+
+@st.cache_data(show_spinner=False, ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_MAX_ENTRIES)
+def cached_patient_info(ref_digest, pa_digest, _loop, _ref_path, _pa_path):
+    """
+    Uploads both PDFs and extracts patient info, once per pair of inputs.
+    """
+    ref_part = cached_upload(ref_digest, _ref_path)
+    pa_part = cached_upload(pa_digest, _pa_path)
+    return _loop.run_until_complete(extract_patient_info(ref_part, pa_part))
+
+
+@st.cache_data(show_spinner=False, ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_MAX_ENTRIES)
+def cached_field_mapping(pa_digest, ref_digest, _loop, _pa_path, _ref_path, _pa_doc,
+                         _fields, _fields_by_page, _patient_info):
+    """
+    Runs map_fields over every page with fields, once per pair of inputs.
+    """
+    pa_part = cached_upload(pa_digest, _pa_path)
+    ref_part = cached_upload(ref_digest, _ref_path)
+    page_fields = {p: describe_fields(_fields, indices) for p, indices in _fields_by_page.items()}
+    return _loop.run_until_complete(
+        map_fields(_pa_doc, pa_digest, pa_part, ref_part, page_fields, _patient_info)
+    )
 
 # Main Streamlit app
 st.title("MedFill - Automate Insurance Forms")
@@ -126,128 +553,80 @@ if st.button("Process and Fill"):  # Button triggers entire workflow
         st.error("Please upload both the PA form and the referral package.")
         st.stop()
 
-    # Read file bytes
-    pa_bytes = pa_file.read()
-    ref_bytes = ref_file.read()
+    # Spool uploads to disk so fitz and Gemini read files rather than extra
+    # bytes copies; removed at the end of the run, or by the
+    # TemporaryDirectory finalizer if the run stops early
+    workdir = tempfile.TemporaryDirectory(prefix="medfill_")
+    pa_path, pa_digest = spool_upload(pa_file, workdir.name)
+    ref_path, ref_digest = spool_upload(ref_file, workdir.name)
+
+    # One event loop for every Gemini call in this run; the async client's
+    # connection pool is bound to the loop it was first used on
+    loop = asyncio.new_event_loop()
 
     # 1) Extract patient info
     try:
-        patient_info = extract_patient_info(ref_bytes, pa_bytes)
+        patient_info = cached_patient_info(ref_digest, pa_digest, loop, ref_path, pa_path)
     except Exception as e:
+        loop.close()
         st.error(f"Failed to extract patient info: {e}")
         st.stop()
 
     # 2) Extract PA fields
-    fields = extract_fields_with_positions(pa_bytes)
-    fields_by_page = {}
-    for f in fields:
-        fields_by_page.setdefault(f["page"], []).append({
-            "id":   f["name"],
-            "type": f["type"],
-            "rect": f["rect"]
-        })
-
-    # 3) Page-by-page context and mapping
-    field_context_by_page = {}
-    field_mapping = {}
-
-    for page_no, page_fields in sorted(fields_by_page.items()):
-        # Context extraction (user's prompt)
-        page_part = make_page_part(pa_bytes, page_no)
-        prompt_ctx = f"""
-            You’re annotating page {page_no} of a medical form.
-            Given:
-            - This page’s form fields (id,type,rect).
-            - Actual Prior Authorization form.
-
-            For each field:
-            Add question and context fields to already existing field objects
-            Move sequentially through the page for each field along with fields info attached.
-
-            Generate the best possible context around that field object in 25 words. Provide a proper context to actually give more insight into what the question actually is. If the question needs any background info to make sense, add that into the context.
-            Getting the correct context for correct field is extremely important for correct mapping.
-
-            Return a JSON object mapping field IDs to:
-            - For each form field object add its question corresponding to it i.e what is the question asked for CB1 or T1 for all the fields
-            - Also indicate the context in which the question is asked. Sometimes, the question itself does not give a lot of context. For example if a question is First Name it should be known if it is the patients name or the insurer's. Also if a question is a sub question of another question, it should be known the context of it.
-            - Only add context and question as additional fields to each object
-            - Return a JSON object mapping field names (e.g., "T1", "CB1") to their filled values, as given with an additional element in the object as the question corresponding to it.
-
-            Only output valid JSON.
-
-            Each output JSON object should only contain the fields - name, page, question, context in the following format
-            {{"name": "T67", "page": 2, "question": "","context": "" }}
-
-            Return all the objects as a JSON inside {{}}
-
-            Here are the fields:
-            {json.dumps(page_fields, indent=2)}
-            """
-        resp_ctx = client.models.generate_content(
-            model=MODEL_CTX,
-            contents=[page_part, prompt_ctx]
-        ).text
-        print(resp_ctx)
-        ctx = json.loads(extract_json(resp_ctx))
-        field_context_by_page[page_no] = ctx
-
-        # Mapping extraction (user's prompt)
-        prompt_map = f"""
-        You’re filling page {page_no} of the attached Prior Authorization form.
-        Given:
-        1. This page’s form fields (id,type).
-        2. Detailed patient info.
-        3. This page’s field context mapping.
-        You are a smart form-filling assistant.
-
-        Carefully look into the context and question for each field. Then see if the patient info has information for it. If it has good create mapping. But if it does not have do not create a mapping for it.
-
-        Be intelligent in creating mappings. See the context and decide on the mapping. Make full use of understanding context.
-        Do not map inappropriate content with inappropriate field.
-
-            Cleverly match the right patient info to applicable field. Use the info from patient info to map form fields based on questions and context from structured info. Use:
-            - Text for text fields
-            - `true` / `false` for checkboxes
-            - Leave irrelevant fields blank or `false`
-            - Do Not fill in the fields for which information is not present in patient info
-
-            A name field should be filled with name, an address field with address etc.
-            Do not add the field in mapping if info about it is not present.
-
-        Return valid JSON {{field_id:value}}.
-        
-        --- PATIENT INFO ---
-        {json.dumps(patient_info, indent=2)}
-        --- FIELD CONTEXT ---
-        {json.dumps(field_context_by_page[page_no], indent=2)}
-        """
-        resp_map = client.models.generate_content(
-            model=MODEL_MAP,
-            contents=[page_part, prompt_map]
-        ).text
-        print(resp_map)
-        mapping = json.loads(extract_json(resp_map))
-        field_mapping.update(mapping)
+    # Parse the PA form once; it is reused for fields, page parts and filling
+    pa_doc = fitz.open(pa_path)
+    fields = extract_fields_with_positions(pa_doc)
+    fields_by_page = {}  # page_no -> positions into the field arrays
+    for i, page_no in enumerate(fields["pages"]):
+        fields_by_page.setdefault(page_no, []).append(i)
+
+    # 3) Context and mapping
+    # The whole form in one request when it fits, otherwise page by page with
+    # up to MAX_IN_FLIGHT pages in flight.
+    try:
+        field_mapping = cached_field_mapping(
+            pa_digest, ref_digest, loop, pa_path, ref_path, pa_doc,
+            fields, fields_by_page, patient_info
+        )
+    finally:
+        loop.close()
 
     # 4) Fill PDF
-    doc = fitz.open(stream=pa_bytes, filetype="pdf")
-    for page in doc:
-        for w in page.widgets() or []:
+    # Only visit pages that have a mapped field, and only rewrite widgets whose
+    # value actually changes; each update() rewrites the widget's appearance.
+    # PyMuPDF has no batched widget write (no per-page update), so changed
+    # widgets are still committed one update() at a time.
+    pages_to_fill = {
+        fields["pages"][i] for i, name in enumerate(fields["names"]) if name in field_mapping
+    }
+    for page_no in sorted(pages_to_fill):
+        for w in pa_doc[page_no-1].widgets() or []:
             fid = w.field_name
             if fid in field_mapping:
                 val = field_mapping[fid]
                 if w.field_type == fitz.PDF_WIDGET_TYPE_CHECKBOX:
-                    w.field_value = "Yes" if bool(val) else "Off"
+                    checked = isinstance(val, (bool, int, str)) and val in _CHECKBOX_TRUE
+                    target = "Yes" if checked else "Off"
                 else:
-                    w.field_value = str(val)
+                    target = str(val)
+                if w.field_value == target:
+                    continue
+                w.field_value = target
                 w.update()
-    out_buf = BytesIO()
-    doc.save(out_buf)
+    # Save straight to disk (garbage-collected, deflated and cleaned up) rather
+    # than into a BytesIO that is then copied out. download_button still reads
+    # the whole file into memory, so this only drops that extra copy.
+    with tempfile.NamedTemporaryFile(dir=workdir.name, suffix=".pdf", delete=False) as out_file:
+        out_path = out_file.name
+    pa_doc.save(out_path, garbage=4, deflate=True, clean=True)
+    pa_doc.close()
 
     # Download filled PDF
-    st.download_button(
-        label="Download Filled PA Form",
-        data=out_buf.getvalue(),
-        file_name="filled_PA.pdf",
-        mime="application/pdf"
-    )
+    with open(out_path, "rb") as out_file:
+        st.download_button(
+            label="Download Filled PA Form",
+            data=out_file,
+            file_name="filled_PA.pdf",
+            mime="application/pdf"
+        )
+    workdir.cleanup()